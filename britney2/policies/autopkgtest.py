@@ -16,26 +16,29 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+import bisect
 import calendar
 import collections
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
 from enum import Enum
+import functools
 import os
 import json
 import tarfile
 import io
-import itertools
 import re
 import socket
 import sqlite3
 import sys
 import hashlib
+import http.client
+import threading
 import time
 import traceback
 import urllib.parse
-from urllib.error import HTTPError
-from urllib.request import urlopen
+from urllib.error import HTTPError, URLError
+from urllib.request import getproxies, urlopen
 
 import apt_pkg
 
@@ -71,11 +74,57 @@ EXCUSES_LABELS = {
     "RUNNING-ALWAYSFAIL": '<span style="background:#99ddff">Test in progress (will not be considered a regression)</span>',
 }
 
+# groups of Result members; tuples, as testing them for membership is
+# cheaper than hashing the members for a set
+FAIL_RESULTS = (Result.FAIL, Result.OLD_FAIL)
+PASS_RESULTS = (Result.PASS, Result.OLD_PASS)
+OLD_RESULTS = (Result.OLD_PASS, Result.OLD_FAIL, Result.OLD_NEUTRAL)
+CURRENT_OK_RESULTS = (Result.PASS, Result.NEUTRAL)
+OK_RESULTS = (Result.PASS, Result.NEUTRAL, Result.OLD_PASS, Result.OLD_NEUTRAL)
+
+# statuses of tests which have not finished yet
+RUNNING_STATUSES = frozenset({'RUNNING', 'RUNNING-ALWAYSFAIL'})
+# statuses which do not need any action, and thus are not shown in excuses
+NO_ACTION_STATUSES = frozenset({'PASS', 'NEUTRAL', 'RUNNING-ALWAYSFAIL', 'ALWAYSFAIL', 'IGNORE-FAIL'})
+
 REF_TRIG = 'migration-reference/0'
 
 SECPERDAY = 24 * 60 * 60
 
+# gcc-N, as opposed to other compilers like gcc-snapshot
+GCC_VERSIONED_RE = re.compile(r'gcc-\d+$')
+
+# attempts for each download, and initial delay between them in seconds
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_DELAY = 0.5
+# redirects to follow for each download, as many as urlopen() does
+MAX_REDIRECTS = 10
+
+# number of concurrent downloads from swift
+SWIFT_FETCH_WORKERS = 16
+
+# the members of a result.tar that we look at
+RESULT_MEMBERS = ('exitcode', 'testpkg-version', 'testinfo.json')
+# beyond this many unread bytes, dropping the connection is cheaper than
+# downloading the rest of a result.tar just to be able to reuse it
+RESULT_DRAIN_LIMIT = 1024 * 1024
+
+
+@functools.lru_cache(maxsize=65536)
+def version_compare(a, b):
+    '''apt_pkg.version_compare(), remembering results
+
+    The same few versions of each test get compared against each other over
+    and over again, e. g. for every trigger in check_ever_passed_before().
+    '''
+    return apt_pkg.version_compare(a, b)
+
 
+# sort/max() key ordering Debian version strings
+version_key = functools.cmp_to_key(version_compare)
+
+
+@functools.lru_cache(maxsize=None)
 def srchash(src):
     '''archive hash prefix for source package'''
 
@@ -100,6 +149,23 @@ def all_leaf_results(test_results):
             yield from arch.values()
 
 
+def run_id_timestamp(run_id):
+    '''Unix time of a test run, from its YYYYmmdd_HHMMSS run ID
+
+    This is called for every fetched result; time.strptime() is about five
+    times slower than picking the fields apart by hand.
+    '''
+    return calendar.timegm((int(run_id[0:4]), int(run_id[4:6]), int(run_id[6:8]),
+                            int(run_id[9:11]), int(run_id[11:13]), int(run_id[13:15])))
+
+
+def result_to_json(obj):
+    '''json.dumps() hook storing Result members by name'''
+    if isinstance(obj, Result):
+        return obj.name
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+
 def mark_result_as_old(result):
     '''Convert current result into corresponding old result'''
 
@@ -125,11 +191,34 @@ class AutopkgtestPolicy(BasePolicy):
         # tests requested in this and previous runs
         # trigger -> src -> [arch]
         self.pending_tests = None
+        # whether pending_tests differs from what is on disk
+        self.pending_tests_dirty = False
+        # whether test_results differs from the results cache on disk
+        self.test_results_dirty = False
         self.pending_tests_file = os.path.join(self.state_dir, 'autopkgtest-pending.json')
-        self.testsuite_triggers = {}
+        # requests queued since pending_tests_file was last written, one JSON
+        # [trigger, src, arch] per line, so that a crash does not lose them
+        self.pending_tests_log = self.pending_tests_file + '.log'
+        self.pending_tests_log_handle = None
+        self.testsuite_triggers = collections.defaultdict(set)
+        # (src, ver) -> fixed list of tests for specially handled sources
+        self.special_tests_cache = {}
+        # src -> arch -> whether src has a test in the target suite
+        self.target_tests_cache = collections.defaultdict(dict)
+        # (src, ver) -> result of rdeps_of_binaries() for all of its binaries
+        self.source_rdeps_cache = {}
         self.result_in_baseline_cache = collections.defaultdict(dict)
         self.database_path = os.path.join(self.state_dir, 'autopkgtest.db')
         self.dry_run = dry_run
+        # per thread: (scheme, netloc) -> [connection, last response]
+        self.http_local = threading.local()
+        # results are downloaded from swift in parallel; this protects
+        # test_results against updates while download threads look at it
+        self.results_lock = threading.Lock()
+        self.fetch_pool = ThreadPoolExecutor(max_workers=SWIFT_FETCH_WORKERS)
+        # separate pool for the result.tar downloads of each fetch_pool job,
+        # so that those never wait for a free worker of their own pool
+        self.result_pool = ThreadPoolExecutor(max_workers=SWIFT_FETCH_WORKERS)
 
         # results map: trigger -> src -> arch -> [passed, version, run_id, seen]
         # - trigger is "source/version" of an unstable package that triggered
@@ -141,6 +230,15 @@ class AutopkgtestPolicy(BasePolicy):
         # - "seen" is an approximate time stamp of the test run. How this is
         #   deduced depends on the interface used.
         self.test_results = {}
+        # inverse of test_results: src -> arch -> set of triggers with a result
+        self.result_triggers = collections.defaultdict(lambda: collections.defaultdict(set))
+        # trigger -> position in test_results, to visit a subset of the
+        # triggers in the same order as iterating test_results does
+        self.trigger_order = {}
+        # (src, arch) pairs with a passing result for any trigger; an entry
+        # may be stale (the pass got overwritten), but a missing one means
+        # that there is no pass to look for
+        self.passed_src_arch = set()
         if self.options.adt_shared_results_cache:
             self.results_cache_file = self.options.adt_shared_results_cache
         else:
@@ -160,14 +258,21 @@ class AutopkgtestPolicy(BasePolicy):
         self.swift_container = 'autopkgtest-' + options.series
         if self.options.adt_ppas:
             self.swift_container += '-' + options.adt_ppas[-1].replace('/', '-')
+        # the part of the log URLs which is the same for all results
+        if self.options.adt_swift_url.startswith('file://'):
+            self.log_url_prefix = os.path.join(self.options.adt_ci_url, 'data', 'autopkgtest', self.options.series)
+        else:
+            self.log_url_prefix = os.path.join(self.options.adt_swift_url, self.swift_container, self.options.series)
 
         # restrict adt_arches to architectures we actually run for
-        self.adt_arches = []
+        adt_arches = []
         for arch in self.options.adt_arches.split():
             if arch in self.options.architectures:
-                self.adt_arches.append(arch)
+                adt_arches.append(arch)
             else:
                 self.logger.info("Ignoring ADT_ARCHES %s as it is not in architectures list", arch)
+        # fixed for the whole run
+        self.adt_arches = tuple(adt_arches)
 
     def fetch_db(self):
         f = None
@@ -216,7 +321,7 @@ class AutopkgtestPolicy(BasePolicy):
         for suite in self.suite_info:
             for src, data in suite.sources.items():
                 for trigger in data.testsuite_triggers:
-                    self.testsuite_triggers.setdefault(trigger, set()).add(src)
+                    self.testsuite_triggers[trigger].add(src)
         target_suite_name = self.suite_info.target_suite.name
 
         os.makedirs(self.state_dir, exist_ok=True)
@@ -238,9 +343,17 @@ class AutopkgtestPolicy(BasePolicy):
             with open(self.results_cache_file) as f:
                 test_results = json.load(f)
                 self.test_results = self.check_and_upgrade_cache(test_results)
+            for (trigger, srcmap) in self.test_results.items():
+                self.trigger_order[trigger] = len(self.trigger_order)
+                for (src, archmap) in srcmap.items():
+                    for (arch, result) in archmap.items():
+                        self.result_triggers[src][arch].add(trigger)
+                        if result[0] in PASS_RESULTS:
+                            self.passed_src_arch.add((src, arch))
             self.logger.info('Read previous results from %s', self.results_cache_file)
         else:
             self.logger.info('%s does not exist, re-downloading all results from swift', self.results_cache_file)
+            self.test_results_dirty = True
 
         # read in the new results
         if self.options.adt_swift_url.startswith('file://'):
@@ -251,6 +364,7 @@ class AutopkgtestPolicy(BasePolicy):
                 self.logger.info('Read new results from %s', debci_file)
                 # With debci, pending tests are determined from the debci file
                 self.pending_tests = {}
+                self.pending_tests_dirty = True
                 for res in test_results['results']:
                     # Blacklisted tests don't get a version
                     if res['version'] is None:
@@ -276,8 +390,7 @@ class AutopkgtestPolicy(BasePolicy):
                             arch_list = self.pending_tests.setdefault(trigger, {}).setdefault(src, [])
                             if arch not in arch_list:
                                 self.logger.info('Pending autopkgtest %s on %s to verify %s', src, arch, trigger)
-                                arch_list.append(arch)
-                                arch_list.sort()
+                                bisect.insort(arch_list, arch)
                         elif status == 'tmpfail':
                             # let's see if we still need it
                             continue
@@ -301,31 +414,45 @@ class AutopkgtestPolicy(BasePolicy):
         # Initialize AMQP connection
         self.amqp_channel = None
         self.amqp_file = None
+        self.amqp_file_handle = None
         if self.options.dry_run or self.dry_run:
             return
 
         amqp_url = self.options.adt_amqp
 
         if amqp_url.startswith('amqp://'):
-            import amqplib.client_0_8 as amqp
             # depending on the setup we connect to a AMQP server
-            creds = urllib.parse.urlsplit(amqp_url, allow_fragments=False)
-            self.amqp_con = amqp.Connection(creds.hostname, userid=creds.username,
-                                            password=creds.password)
-            self.amqp_channel = self.amqp_con.channel()
-            self.logger.info('Connected to AMQP server')
+            self.amqp_connect(amqp_url)
         elif amqp_url.startswith('file://'):
             # or in Debian and in testing mode, adt_amqp will be a file:// URL
             self.amqp_file = amqp_url[7:]
         else:
             raise RuntimeError('Unknown ADT_AMQP schema %s' % amqp_url.split(':', 1)[0])
 
+    def amqp_connect(self, amqp_url):
+        '''Open the AMQP connection and channel used for all test requests'''
+
+        import amqplib.client_0_8 as amqp
+        # when reconnecting, don't leak the socket of the broken connection
+        old_con = getattr(self, 'amqp_con', None)
+        if old_con is not None:
+            try:
+                old_con.close()
+            except Exception:
+                pass
+        creds = urllib.parse.urlsplit(amqp_url, allow_fragments=False)
+        self.amqp_con = amqp.Connection(creds.hostname, userid=creds.username,
+                                        password=creds.password)
+        self.amqp_channel = self.amqp_con.channel()
+        self.logger.info('Connected to AMQP server')
+
     def check_and_upgrade_cache(self, test_results):
         for result in all_leaf_results(test_results):
             try:
                 result[0] = Result[result[0]]
             except KeyError:
                 # Legacy support
+                self.test_results_dirty = True
                 if isinstance(result[0], type(True)):
                     if result[0]:
                         result[0] = Result.PASS
@@ -338,6 +465,7 @@ class AutopkgtestPolicy(BasePolicy):
                 dummy = result[3]
             except IndexError:
                 result.append(self._now)
+                self.test_results_dirty = True
         return test_results
 
     def filter_old_results(self):
@@ -355,9 +483,14 @@ class AutopkgtestPolicy(BasePolicy):
                 for (arch, result) in results.items():
                     if trigger == REF_TRIG and \
                       result[3] < self._now - self.options.adt_reference_max_age:
-                        result[0] = mark_result_as_old(result[0])
+                        old = mark_result_as_old(result[0])
                     elif not self.test_version_in_any_suite(src, result[1]):
-                        result[0] = mark_result_as_old(result[0])
+                        old = mark_result_as_old(result[0])
+                    else:
+                        continue
+                    if old != result[0]:
+                        result[0] = old
+                        self.test_results_dirty = True
 
     def test_version_in_any_suite(self, src, version):
         '''Check if the mentioned version of src is found in a suite
@@ -380,7 +513,7 @@ class AutopkgtestPolicy(BasePolicy):
 
         valid_version = False
         for ver in versions:
-            if apt_pkg.version_compare(ver, version) == 0:
+            if version_compare(ver, version) == 0:
                 valid_version = True
                 break
 
@@ -389,24 +522,69 @@ class AutopkgtestPolicy(BasePolicy):
     def save_pending_json(self):
         # update the pending tests on-disk cache
         self.logger.info('Updating pending requested tests in %s' % self.pending_tests_file)
+        # encode in one go and hand the file a single buffer; json.dump()
+        # would issue a write() for every little chunk of output. Keep it
+        # compact: json only uses its C encoder without indentation
         with open(self.pending_tests_file + '.new', 'w') as f:
-            json.dump(self.pending_tests, f, indent=2)
-        os.rename(self.pending_tests_file + '.new', self.pending_tests_file)
+            f.write(json.dumps(self.pending_tests, separators=(',', ':')))
+            # make sure the data is on disk before the rename, so that a
+            # crash cannot leave us with an empty file
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.pending_tests_file + '.new', self.pending_tests_file)
+        self.pending_tests_dirty = False
+
+        # everything in the log is in pending_tests_file now
+        if self.pending_tests_log_handle is not None:
+            self.pending_tests_log_handle.close()
+            self.pending_tests_log_handle = None
+        try:
+            os.unlink(self.pending_tests_log)
+        except FileNotFoundError:
+            pass
+
+    def log_pending_request(self, trigger, src, arch):
+        '''Record a newly queued request on disk right away
+
+        This only appends to pending_tests_log instead of rewriting all of
+        pending_tests_file for every request; save_pending_json() folds it
+        in.
+        '''
+        if self.pending_tests_log_handle is None:
+            # line buffered, so that each request is on disk as soon as it
+            # is recorded as pending
+            self.pending_tests_log_handle = open(self.pending_tests_log, 'a', buffering=1)
+        self.pending_tests_log_handle.write(json.dumps([trigger, src, arch]) + '\n')
+        self.pending_tests_dirty = True
 
     def save_state(self, britney):
         super().save_state(britney)
 
         # update the results on-disk cache, unless we are using a r/o shared one
-        if not self.options.adt_shared_results_cache:
+        if self.options.adt_shared_results_cache:
+            pass
+        elif self.test_results_dirty:
             self.logger.info('Updating results cache')
-            test_results = deepcopy(self.test_results)
-            for result in all_leaf_results(test_results):
-                result[0] = result[0].name
+            # no indentation: it doubles the size of the file, and json only
+            # uses its C encoder for compact output
             with open(self.results_cache_file + '.new', 'w') as f:
-                json.dump(test_results, f, indent=2)
-            os.rename(self.results_cache_file + '.new', self.results_cache_file)
+                f.write(json.dumps(self.test_results, separators=(',', ':'), default=result_to_json))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.results_cache_file + '.new', self.results_cache_file)
+            self.test_results_dirty = False
+        else:
+            self.logger.info('Results unchanged, not updating %s', self.results_cache_file)
 
-        self.save_pending_json()
+        if self.pending_tests_dirty:
+            self.save_pending_json()
+        else:
+            self.logger.info('Pending requested tests unchanged, not updating %s', self.pending_tests_file)
+        self.fetch_pool.shutdown()
+        self.result_pool.shutdown()
+        if self.amqp_file_handle is not None:
+            self.amqp_file_handle.close()
+            self.amqp_file_handle = None
 
     def apply_src_policy_impl(self, tests_info, item, source_data_tdist, source_data_srcdist, excuse):
         # initialize
@@ -436,6 +614,8 @@ class AutopkgtestPolicy(BasePolicy):
             # want to evaluate and present the results by tested source package
             # first
             pkg_arch_result = collections.defaultdict(dict)
+            bin_triggers = None
+            arch_tests = []
             for arch in self.adt_arches:
                 if arch in excuse.missing_builds:
                     verdict = PolicyVerdict.REJECTED_TEMPORARILY
@@ -446,19 +626,34 @@ class AutopkgtestPolicy(BasePolicy):
                     self.logger.info('%s is uninstallable on arch %s, not running autopkgtest there', source_name, arch)
                     excuse.addinfo("uninstallable on arch %s, not running autopkgtest there" % arch)
                 else:
-                    self.request_tests_for_source(item, arch, source_data_srcdist, pkg_arch_result, excuse)
+                    if bin_triggers is None:
+                        # this does not depend on the arch, so only do it once
+                        bin_triggers = self.find_bin_triggers(item, source_data_srcdist)
+                    arch_tests.append((arch, self.tests_for_source(source_name, source_data_srcdist.version,
+                                                                   arch, excuse)))
+
+            # look for new results of all architectures at once, rather than
+            # waiting for swift once per architecture
+            self.prefetch_swift_results(arch_tests, trigger)
+            for (arch, tests) in arch_tests:
+                self.request_tests_for_source(item, arch, tests, source_data_srcdist, trigger, bin_triggers,
+                                              pkg_arch_result)
 
             # add test result details to Excuse
-            cloud_url = self.options.adt_ci_url + "packages/%(h)s/%(s)s/%(r)s/%(a)s"
-            for (testsrc, testver) in sorted(pkg_arch_result):
-                arch_results = pkg_arch_result[(testsrc, testver)]
+            ci_url = self.options.adt_ci_url
+            series = self.options.series
+            ppas = self.options.adt_ppas
+            retry_by_run_id = self.options.adt_retry_url_mech == 'run_id'
+            cloud_url = ci_url + "packages/%(h)s/%(s)s/%(r)s/%(a)s"
+            # keys are unique, so sorting the items never compares the values
+            for ((testsrc, testver), arch_results) in sorted(pkg_arch_result.items()):
                 r = {v[0] for v in arch_results.values()}
                 if 'REGRESSION' in r:
                     verdict = PolicyVerdict.REJECTED_PERMANENTLY
                 elif ('RUNNING' in r or 'RUNNING-REFERENCE' in r) and verdict == PolicyVerdict.PASS:
                     verdict = PolicyVerdict.REJECTED_TEMPORARILY
                 # skip version if still running on all arches
-                if not r - {'RUNNING', 'RUNNING-ALWAYSFAIL'}:
+                if r <= RUNNING_STATUSES:
                     testver = None
 
                 # A source package is elegible for the bounty if it has tests
@@ -472,28 +667,27 @@ class AutopkgtestPolicy(BasePolicy):
                     testname = testsrc
 
                 html_archmsg = []
-                for arch in sorted(arch_results):
-                    (status, run_id, log_url) = arch_results[arch]
+                for (arch, (status, run_id, log_url)) in sorted(arch_results.items()):
                     artifact_url = None
                     retry_url = None
                     history_url = None
-                    if self.options.adt_ppas:
+                    if ppas:
                         if log_url.endswith('log.gz'):
                             artifact_url = log_url.replace('log.gz', 'artifacts.tar.gz')
                     else:
                         history_url = cloud_url % {
                             'h': srchash(testsrc), 's': testsrc,
-                            'r': self.options.series, 'a': arch}
+                            'r': series, 'a': arch}
                     if status in ['REGRESSION', 'RUNNING-REFERENCE']:
-                        if self.options.adt_retry_url_mech == 'run_id':
-                            retry_url = self.options.adt_ci_url + 'api/v1/retry/' + run_id
+                        if retry_by_run_id:
+                            retry_url = ci_url + 'api/v1/retry/' + run_id
                         else:
-                            retry_url = self.options.adt_ci_url + 'request.cgi?' + \
-                                    urllib.parse.urlencode([('release', self.options.series),
+                            retry_url = ci_url + 'request.cgi?' + \
+                                    urllib.parse.urlencode([('release', series),
                                                             ('arch', arch),
                                                             ('package', testsrc),
                                                             ('trigger', trigger)] +
-                                                           [('ppa', p) for p in self.options.adt_ppas])
+                                                           [('ppa', p) for p in ppas])
 
                     tests_info.setdefault(testname, {})[arch] = \
                         [status, log_url, history_url, artifact_url, retry_url]
@@ -512,7 +706,7 @@ class AutopkgtestPolicy(BasePolicy):
 
                 # render HTML line for testsrc entry, but only when action is
                 # or may be required
-                if r - {'PASS', 'NEUTRAL', 'RUNNING-ALWAYSFAIL', 'ALWAYSFAIL', 'IGNORE-FAIL'}:
+                if not r <= NO_ACTION_STATUSES:
                     results_info.append("autopkgtest for %s: %s" % (testname, ', '.join(html_archmsg)))
 
         if verdict != PolicyVerdict.PASS:
@@ -563,26 +757,22 @@ class AutopkgtestPolicy(BasePolicy):
                 bininfo = binaries[pkg_id.package_name]
             except KeyError:
                 continue
-            if 'dkms' in (bininfo.depends or ''):
+            # the substring test is cheap and rules out nearly everything;
+            # parse the rest so that e. g. "libdkms-foo" does not count
+            if 'dkms' in (bininfo.depends or '') and \
+                    any(dep[0] == 'dkms' for block in apt_pkg.parse_depends(bininfo.depends) for dep in block):
                 return True
         return False
 
-    def request_tests_for_source(self, item, arch, source_data_srcdist, pkg_arch_result, excuse):
+    def find_bin_triggers(self, item, source_data_srcdist):
+        '''Find the binaries which need to come from the source suite for testing item
+
+        This covers all architectures; request_tests_for_source() picks the
+        ones for the arch it is looking at.
+        '''
         pkg_universe = self.britney.pkg_universe
         target_suite = self.suite_info.target_suite
         source_suite = item.suite
-        sources_t = target_suite.sources
-        sources_s = item.suite.sources
-        packages_s_a = item.suite.binaries[arch]
-        source_name = item.package
-        source_version = source_data_srcdist.version
-        # request tests (unless they were already requested earlier or have a result)
-        tests = self.tests_for_source(source_name, source_version, arch, excuse)
-        is_huge = False
-        try:
-            is_huge = len(tests) > int(self.options.adt_huge)
-        except AttributeError:
-            pass
 
         # Here we figure out what is required from the source suite
         # for the test to install successfully.
@@ -603,9 +793,6 @@ class AutopkgtestPolicy(BasePolicy):
         # we need to check if any of the packages that we now
         # enforce being from the source suite, actually have new
         # versioned depends and new breaks/conflicts.
-        #
-        # For all binaries found, add the set of unique source
-        # packages to the list of triggers.
 
         bin_triggers = set()
         bin_new = set(source_data_srcdist.binaries)
@@ -646,11 +833,63 @@ class AutopkgtestPolicy(BasePolicy):
                 p for p in broken if
                 p.package_name in broken_in_target and
                 p.package_name not in broken_in_source)
-            # We add the version in the target suite, but the code below will
-            # change it to the version in the source suite
+            # We add the version in the target suite, but
+            # request_tests_for_source() will change it to the version in
+            # the source suite
             bin_broken.update(broken_filtered)
         bin_triggers.update(bin_broken)
+        return bin_triggers
+
+    def has_test_in_target(self, src, arch):
+        '''Check if src in the target suite has an autopkgtest on arch
 
+        The same reverse dependencies come up for lots of triggers, so the
+        answer is remembered. Raises KeyError if src is not in the target
+        suite.
+        '''
+        try:
+            return self.target_tests_cache[src][arch]
+        except KeyError:
+            pass
+
+        target_suite = self.suite_info.target_suite
+        srcinfo = target_suite.sources[src]
+        has_test = 'autopkgtest' in srcinfo.testsuite or self.has_autodep8(srcinfo, target_suite.binaries[arch])
+        self.target_tests_cache[src][arch] = has_test
+        return has_test
+
+    def rdeps_of_binaries(self, binaries):
+        '''Find what may need testing for binaries
+
+        Return a (rdeps, tdeps) pair of sets: the package names of the
+        direct reverse dependencies of binaries, and the source packages
+        which list any of them in Testsuite-Triggers.
+        '''
+        pkg_universe = self.britney.pkg_universe
+        rdeps = set()
+        tdeps = set()
+        for binary in binaries:
+            rdeps.update(rdep.package_name for rdep in pkg_universe.reverse_dependencies_of(binary))
+            tdeps.update(self.testsuite_triggers.get(binary.package_name, ()))
+        return (rdeps, tdeps)
+
+    def request_tests_for_source(self, item, arch, tests, source_data_srcdist, trigger, bin_triggers, pkg_arch_result):
+        '''Request tests (unless they were already requested earlier or have a result)
+
+        tests is what tests_for_source() returned for item on arch.
+        '''
+        target_suite = self.suite_info.target_suite
+        sources_t = target_suite.sources
+        sources_s = item.suite.sources
+        packages_s_a = item.suite.binaries[arch]
+        is_huge = False
+        try:
+            is_huge = len(tests) > int(self.options.adt_huge)
+        except AttributeError:
+            pass
+
+        # For all binaries found by find_bin_triggers(), add the set of
+        # unique source packages to the list of triggers.
         triggers = set()
         for binary in bin_triggers:
             if binary.architecture == arch:
@@ -667,7 +906,7 @@ class AutopkgtestPolicy(BasePolicy):
                     # (e.g. -dbg to -dbgsym)
                     pass
                 if binary not in source_data_srcdist.binaries:
-                    for tdep_src in self.testsuite_triggers.get(binary.package_name, set()):
+                    for tdep_src in self.testsuite_triggers.get(binary.package_name, ()):
                         try:
                             if (sources_t.get(tdep_src, None) is None or
                                     sources_s[tdep_src].version != sources_t[tdep_src].version):
@@ -679,9 +918,8 @@ class AutopkgtestPolicy(BasePolicy):
                             # unstable (testsuite_triggers are unified
                             # over all suites)
                             pass
-        trigger = source_name + '/' + source_version
         triggers.discard(trigger)
-        triggers_list = sorted(list(triggers))
+        triggers_list = sorted(triggers)
         triggers_list.insert(0, trigger)
 
         for (testsrc, testver) in tests:
@@ -689,17 +927,20 @@ class AutopkgtestPolicy(BasePolicy):
             (result, real_ver, run_id, url) = self.pkg_test_result(testsrc, testver, arch, trigger)
             pkg_arch_result[(testsrc, real_ver)][arch] = (result, run_id, url)
 
-    def tests_for_source(self, src, ver, arch, excuse):
-        '''Iterate over all tests that should be run for given source and arch'''
+    def special_tests_for_source(self, src, ver):
+        '''Return the fixed list of tests for specially handled sources
 
-        source_suite = self.suite_info.primary_source_suite
-        target_suite = self.suite_info.target_suite
-        sources_info = target_suite.sources
-        binaries_info = target_suite.binaries[arch]
-
-        reported_pkgs = set()
+        Return None for all other sources. This does not depend on the arch,
+        so it is only worked out once per source.
+        '''
+        try:
+            return self.special_tests_cache[(src, ver)]
+        except KeyError:
+            pass
 
-        tests = []
+        source_suite = self.suite_info.primary_source_suite
+        sources_info = self.suite_info.target_suite.sources
+        tests = None
 
         # gcc-N triggers tons of tests via libgcc1, but this is mostly in vain:
         # gcc already tests itself during build, and it is being used from
@@ -707,7 +948,8 @@ class AutopkgtestPolicy(BasePolicy):
         # serves no purpose. Just check some key packages which actually use
         # gcc during the test, and doxygen as an example for a libgcc user.
         if src.startswith('gcc-'):
-            if re.match(r'gcc-\d+$', src) or src == 'gcc-defaults':
+            tests = []
+            if GCC_VERSIONED_RE.match(src) or src == 'gcc-defaults':
                 # add gcc's own tests, if it has any
                 srcinfo = source_suite.sources[src]
                 if 'autopkgtest' in srcinfo.testsuite:
@@ -718,29 +960,45 @@ class AutopkgtestPolicy(BasePolicy):
                     except KeyError:
                         # no package in that series? *shrug*, then not (mostly for testing)
                         pass
-                return tests
-            else:
-                # for other compilers such as gcc-snapshot etc. we don't need
-                # to trigger anything
-                return []
+            # for other compilers such as gcc-snapshot etc. we don't need
+            # to trigger anything
 
         # The raspi kernel can't be tested with autopkgtest. It doesn't support EFI
         # and won't boot in OpenStack.
-        if src.startswith('linux-meta-raspi'):
-            return []
+        elif src.startswith('linux-meta-raspi'):
+            tests = []
 
         # Debian doesn't have linux-meta, but Ubuntu does
         # for linux themselves we don't want to trigger tests -- these should
         # all come from linux-meta*. A new kernel ABI without a corresponding
         # -meta won't be installed and thus we can't sensibly run tests against
         # it.
-        if src.startswith('linux'):
+        elif src.startswith('linux'):
             if src.startswith('linux-signed'):
                 meta = src.replace('linux-signed', 'linux-meta')
             else:
                 meta = src.replace('linux', 'linux-meta')
             if meta in sources_info or meta in source_suite.sources:
-                return []
+                tests = []
+
+        self.special_tests_cache[(src, ver)] = tests
+        return tests
+
+    def tests_for_source(self, src, ver, arch, excuse):
+        '''Iterate over all tests that should be run for given source and arch'''
+
+        tests = self.special_tests_for_source(src, ver)
+        if tests is not None:
+            return tests
+
+        source_suite = self.suite_info.primary_source_suite
+        target_suite = self.suite_info.target_suite
+        sources_info = target_suite.sources
+        binaries_info = target_suite.binaries[arch]
+
+        reported_pkgs = set()
+
+        tests = []
 
         # we want to test the package itself, if it still has a test in unstable
         # but only if the package actually exists on this arch
@@ -776,70 +1034,73 @@ class AutopkgtestPolicy(BasePolicy):
 
         extra_bins = []
         # Debian doesn't have linux-meta, but Ubuntu does
+        # does this have any image on this arch?
+        is_kernel_with_image = src.startswith('linux-meta') and \
+            any(pkg_id.architecture == arch and '-image' in pkg_id.package_name
+                for pkg_id in srcinfo.binaries)
         # Hack: For new kernels trigger all DKMS packages by pretending that
         # linux-meta* builds a "dkms" binary as well. With that we ensure that we
         # don't regress DKMS drivers with new kernel versions.
-        if src.startswith('linux-meta'):
-            # does this have any image on this arch?
-            for pkg_id in srcinfo.binaries:
-                if pkg_id.architecture == arch and '-image' in pkg_id.package_name:
-                    try:
-                        extra_bins.append(binaries_info['dkms'].pkg_id)
-                    except KeyError:
-                        pass
+        if is_kernel_with_image:
+            try:
+                extra_bins.append(binaries_info['dkms'].pkg_id)
+            except KeyError:
+                pass
 
-        pkg_universe = self.britney.pkg_universe
         # plus all direct reverse dependencies and test triggers of its
         # binaries which have an autopkgtest
-        for binary in itertools.chain(srcinfo.binaries, extra_bins):
-            rdeps = pkg_universe.reverse_dependencies_of(binary)
-            for rdep in rdeps:
-                try:
-                    rdep_src = binaries_info[rdep.package_name].source
-                    # Don't re-trigger the package itself here; this should
-                    # have been done above if the package still continues to
-                    # have an autopkgtest in unstable.
-                    if rdep_src == src:
-                        continue
-                except KeyError:
+        try:
+            (rdeps, tdeps) = self.source_rdeps_cache[(src, ver)]
+        except KeyError:
+            (rdeps, tdeps) = self.rdeps_of_binaries(srcinfo.binaries)
+            self.source_rdeps_cache[(src, ver)] = (rdeps, tdeps)
+        if extra_bins:
+            (extra_rdeps, extra_tdeps) = self.rdeps_of_binaries(extra_bins)
+            rdeps = rdeps | extra_rdeps
+            tdeps = tdeps | extra_tdeps
+
+        for rdep in rdeps:
+            try:
+                rdep_src = binaries_info[rdep].source
+                # Don't re-trigger the package itself here; this should
+                # have been done above if the package still continues to
+                # have an autopkgtest in unstable.
+                if rdep_src == src:
                     continue
+            except KeyError:
+                continue
 
-                rdep_src_info = sources_info[rdep_src]
-                if 'autopkgtest' in rdep_src_info.testsuite or self.has_autodep8(rdep_src_info, binaries_info):
-                    if rdep_src not in reported_pkgs:
-                        tests.append((rdep_src, rdep_src_info.version))
-                        reported_pkgs.add(rdep_src)
+            if rdep_src not in reported_pkgs and self.has_test_in_target(rdep_src, arch):
+                tests.append((rdep_src, sources_info[rdep_src].version))
+                reported_pkgs.add(rdep_src)
 
-            for tdep_src in self.testsuite_triggers.get(binary.package_name, set()):
-                if tdep_src not in reported_pkgs:
-                    try:
-                        tdep_src_info = sources_info[tdep_src]
-                    except KeyError:
-                        continue
-                    if 'autopkgtest' in tdep_src_info.testsuite or self.has_autodep8(tdep_src_info, binaries_info):
-                        for pkg_id in tdep_src_info.binaries:
-                            if pkg_id.architecture == arch:
-                                tests.append((tdep_src, tdep_src_info.version))
-                                reported_pkgs.add(tdep_src)
-                                break
+        for tdep_src in tdeps:
+            if tdep_src not in reported_pkgs:
+                try:
+                    has_test = self.has_test_in_target(tdep_src, arch)
+                except KeyError:
+                    continue
+                if has_test:
+                    tdep_src_info = sources_info[tdep_src]
+                    for pkg_id in tdep_src_info.binaries:
+                        if pkg_id.architecture == arch:
+                            tests.append((tdep_src, tdep_src_info.version))
+                            reported_pkgs.add(tdep_src)
+                            break
 
         # Hardcode linux-meta →  linux, lxc, glibc, systemd triggers until we get a more flexible
         # implementation: https://bugs.debian.org/779559
-        if src.startswith('linux-meta'):
+        if is_kernel_with_image:
             for pkg in ['lxc', 'lxd', 'glibc', src.replace('linux-meta', 'linux'), 'systemd', 'snapd']:
                 if pkg not in reported_pkgs:
-                    # does this have any image on this arch?
-                    for pkg_id in srcinfo.binaries:
-                        if pkg_id.architecture == arch and '-image' in pkg_id.package_name:
-                            try:
-                                tests.append((pkg, source_suite.sources[pkg].version))
-                            except KeyError:
-                                try:
-                                    tests.append((pkg, sources_info[pkg].version))
-                                except KeyError:
-                                    # package not in that series? *shrug*, then not
-                                    pass
-                            break
+                    try:
+                        tests.append((pkg, source_suite.sources[pkg].version))
+                    except KeyError:
+                        try:
+                            tests.append((pkg, sources_info[pkg].version))
+                        except KeyError:
+                            # package not in that series? *shrug*, then not
+                            pass
 
         tests.sort(key=lambda s_v: s_v[0])
         return tests
@@ -853,71 +1114,160 @@ class AutopkgtestPolicy(BasePolicy):
         if not os.path.exists(self.pending_tests_file):
             self.logger.info('No %s, starting with no pending tests', self.pending_tests_file)
             self.pending_tests = {}
-            return
-        with open(self.pending_tests_file) as f:
-            self.pending_tests = json.load(f)
-        self.logger.info('Read pending requested tests from %s: %s', self.pending_tests_file, self.pending_tests)
+            self.pending_tests_dirty = True
+        else:
+            with open(self.pending_tests_file, 'rb') as f:
+                self.pending_tests = json.loads(f.read())
+            # dumping the whole structure into the log is as expensive as
+            # parsing it, and unreadable for large queues anyway
+            self.logger.info('Read pending requested tests from %s: %i triggers, %i requests',
+                             self.pending_tests_file, len(self.pending_tests),
+                             sum(len(archs) for srcs in self.pending_tests.values() for archs in srcs.values()))
+
+        # a previous run did not get to save its state; replay the requests
+        # which it queued in the meantime
+        if os.path.exists(self.pending_tests_log):
+            with open(self.pending_tests_log) as f:
+                lines = f.readlines()
+            self.logger.info('Replaying %i pending requests from %s', len(lines), self.pending_tests_log)
+            for line in lines:
+                try:
+                    (trigger, src, arch) = json.loads(line)
+                except ValueError:
+                    # the last line may be cut short by the crash
+                    self.logger.warning('Ignoring damaged line in %s: %s', self.pending_tests_log, line.strip())
+                    continue
+                arch_list = self.pending_tests.setdefault(trigger, {}).setdefault(src, [])
+                if arch not in arch_list:
+                    bisect.insort(arch_list, arch)
+            self.pending_tests_dirty = True
 
     def latest_run_for_package(self, src, arch):
         '''Return latest run ID for src on arch'''
 
-        # this requires iterating over all triggers and thus is expensive;
-        # cache the results
-        try:
-            return self.latest_run_for_package._cache[src][arch]
-        except KeyError:
-            pass
+        # only look at the triggers which have a result for src/arch, rather
+        # than iterating over all of them
+        return max((self.test_results[trigger][src][arch][2]
+                    for trigger in self.result_triggers.get(src, {}).get(arch, ())),
+                   default='')
 
-        latest_run_id = ''
-        for srcmap in self.test_results.values():
-            try:
-                run_id = srcmap[src][arch][2]
-            except KeyError:
-                continue
-            if run_id > latest_run_id:
-                latest_run_id = run_id
+    def http_get(self, url, redirects=0):
+        '''Open url, keeping the connection to its host alive
+
+        Like urlopen(), but subsequent requests to the same host reuse the
+        connection instead of paying for a new TCP and TLS handshake each
+        time; we download lots of small files from swift. Redirects are
+        followed, and other non-2XX responses raise HTTPError.
+        '''
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or parts.scheme in getproxies():
+            return urlopen(url, timeout=30)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
         try:
-            self.latest_run_for_package._cache[src][arch] = latest_run_id
+            connections = self.http_local.connections
+        except AttributeError:
+            connections = self.http_local.connections = {}
+        try:
+            (conn, last) = connections[(parts.scheme, parts.netloc)]
         except KeyError:
-            self.latest_run_for_package._cache[src] = {arch: latest_run_id}
-
-        return latest_run_id
+            if parts.scheme == 'https':
+                conn = http.client.HTTPSConnection(parts.netloc, timeout=30)
+            else:
+                conn = http.client.HTTPConnection(parts.netloc, timeout=30)
+        else:
+            # the previous response was not read completely, so the
+            # connection cannot be reused
+            if last is not None and (not last.isclosed() or last.length):
+                conn.close()
 
-    latest_run_for_package._cache = collections.defaultdict(dict)
+        for attempt in (1, 2):
+            try:
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                break
+            except (http.client.HTTPException, ConnectionError) as e:
+                # the server may have dropped an idle kept-alive connection,
+                # so try once more with a fresh one
+                conn.close()
+                if attempt == 2:
+                    raise URLError(e)
+        connections[(parts.scheme, parts.netloc)] = [conn, resp]
+
+        location = resp.getheader('Location')
+        if resp.status in (301, 302, 303, 307, 308) and location and redirects < MAX_REDIRECTS:
+            target = urllib.parse.urljoin(url, location)
+            # like urlopen(), don't let a server redirect us to e. g. file://
+            if urllib.parse.urlsplit(target).scheme in ('http', 'https'):
+                resp.read()
+                return self.http_get(target, redirects + 1)
+        if resp.status >= 300:
+            raise HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(resp.read()))
+        return resp
 
     def download_retry(self, url):
-        for retry in range(5):
+        '''Download url, retrying transient failures with exponential backoff
+
+        Giving up on a swift request makes the whole run fail, and the next
+        one start all over again; so ride out short outages and overload.
+        '''
+        for retry in range(DOWNLOAD_RETRIES):
+            if retry:
+                time.sleep(DOWNLOAD_RETRY_DELAY * 2 ** (retry - 1))
             try:
-                req = urlopen(url, timeout=30)
+                req = self.http_get(url)
                 code = req.getcode()
                 if not code or 200 <= code < 300:
                     return req
             except socket.timeout as e:
                 self.logger.info(
                     "Timeout downloading '%s', will retry %d more times."
-                    % (url, 5 - retry - 1)
+                    % (url, DOWNLOAD_RETRIES - retry - 1)
                 )
                 exc = e
             except HTTPError as e:
-                if e.code not in (503, 502):
+                if e.code not in (429, 500, 502, 503, 504):
                     raise
                 self.logger.info(
                     "Caught error %d downloading '%s', will retry %d more times."
-                    % (e.code, url, 5 - retry - 1)
+                    % (e.code, url, DOWNLOAD_RETRIES - retry - 1)
+                )
+                exc = e
+            except URLError as e:
+                # e. g. a missing file:// URL is not going to appear
+                if not isinstance(e.reason, (ConnectionError, socket.timeout, http.client.HTTPException)):
+                    raise
+                self.logger.info(
+                    "Failed to connect for downloading '%s' (%s), will retry %d more times."
+                    % (url, e.reason, DOWNLOAD_RETRIES - retry - 1)
                 )
                 exc = e
         else:
             raise exc
 
     def fetch_swift_results(self, swift_url, src, arch):
-        '''Download new results for source package/arch from swift'''
+        '''Download and record new results for source package/arch from swift'''
+
+        for (url, members) in self.download_swift_results(swift_url, src, arch):
+            self.record_result(url, members, src, arch)
+
+    def download_swift_results(self, swift_url, src, arch):
+        '''Download new results for source package/arch from swift
+
+        Return a list of (url, members) pairs as returned by
+        download_result(), oldest first, for record_result(). This does not
+        touch test_results, so that it can run in any thread.
+        '''
 
         # Download results for one particular src/arch at most once in every
         # run, as this is expensive
         done_entry = src + '/' + arch
-        if done_entry in self.fetch_swift_results._done:
-            return
-        self.fetch_swift_results._done.add(done_entry)
+        with self.results_lock:
+            if done_entry in self.fetch_swift_results._done:
+                return []
+            self.fetch_swift_results._done.add(done_entry)
 
         # prepare query: get all runs with a timestamp later than the latest
         # run_id for this package/arch; '@' is at the end of each run id, to
@@ -928,7 +1278,8 @@ class AutopkgtestPolicy(BasePolicy):
 
         # determine latest run_id from results
         if not self.options.adt_shared_results_cache:
-            latest_run_id = self.latest_run_for_package(src, arch)
+            with self.results_lock:
+                latest_run_id = self.latest_run_for_package(src, arch)
             if latest_run_id:
                 query['marker'] = query['prefix'] + latest_run_id
 
@@ -953,7 +1304,7 @@ class AutopkgtestPolicy(BasePolicy):
             # 401 "Unauthorized" is swift's way of saying "container does not exist"
             if hasattr(e, 'code') and e.code == 401:
                 self.logger.info('fetch_swift_results: %s does not exist yet or is inaccessible', url)
-                return
+                return []
             # Other status codes are usually a transient
             # network/infrastructure failure. Ignoring this can lead to
             # re-requesting tests which we already have results for, so
@@ -964,54 +1315,111 @@ class AutopkgtestPolicy(BasePolicy):
             if f is not None:
                 f.close()
 
-        for p in result_paths:
-            self.fetch_one_result(
-                os.path.join(swift_url, self.swift_container, p, 'result.tar'), src, arch)
+        # download the results in parallel, but keep them in order, as later
+        # runs take precedence
+        urls = [os.path.join(swift_url, self.swift_container, p, 'result.tar') for p in result_paths]
+        return [(url, members) for (url, members) in zip(urls, self.result_pool.map(self.download_result, urls))
+                if members is not None]
 
     fetch_swift_results._done = set()
 
-    def fetch_one_result(self, url, src, arch):
-        '''Download one result URL for source/arch
+    def prefetch_swift_results(self, arch_tests, trigger):
+        '''Download new swift results for tests in parallel
 
-        Remove matching pending_tests entries.
+        arch_tests is a list of (arch, tests) pairs, with tests as returned by
+        tests_for_source() for that arch.
+
+        pkg_test_request() looks for new results of every test which has no
+        result for trigger yet, one after the other; as this is dominated by
+        waiting for swift, fetch them all concurrently beforehand.
+        '''
+        if hasattr(self, 'db') or self.options.adt_swift_url.startswith('file://'):
+            return
+
+        # only dispatch the tests which still lack a result for trigger and
+        # which were not fetched already in this run; keep the order of
+        # arch_tests, in which pkg_test_request() would have fetched them
+        srcmap = self.test_results.get(trigger, {})
+        done = self.fetch_swift_results._done
+        jobs = list(dict.fromkeys((testsrc, arch) for (arch, tests) in arch_tests for (testsrc, _) in tests
+                                  if arch not in srcmap.get(testsrc, {}) and testsrc + '/' + arch not in done))
+        # only download in the workers, and record the results here in the
+        # order of the jobs rather than in the order they finish; new
+        # triggers get their trigger_order that way, which decides between
+        # results in result_in_baseline(), so that must not depend on timing
+        downloads = self.fetch_pool.map(lambda job: self.download_swift_results(self.options.adt_swift_url, *job),
+                                        jobs)
+        for ((src, arch), results) in zip(jobs, downloads):
+            for (url, members) in results:
+                self.record_result(url, members, src, arch)
+
+    def download_result(self, url):
+        '''Download one result.tar URL
+
+        Return a dict with the contents of the members we need, or None if
+        the result is missing or damaged.
         '''
         f = None
+        members = {}
         try:
             f = self.download_retry(url)
             if f.getcode() == 200:
-                tar_bytes = io.BytesIO(f.read())
+                # read result.tar as it arrives and pick out the members we
+                # need, instead of buffering the whole download first
+                with tarfile.open(None, 'r|', f) as tar:
+                    for member in tar:
+                        if member.name in RESULT_MEMBERS and member.isfile():
+                            members[member.name] = tar.extractfile(member).read()
+                            if len(members) == len(RESULT_MEMBERS):
+                                break
+                # drain the rest of the response, so that the connection can
+                # be reused; unless that means downloading lots of logs and
+                # artifacts that we don't look at, or of unknown size, or the
+                # server is going to close the connection anyway
+                if f.length is not None and f.length <= RESULT_DRAIN_LIMIT and not f.will_close:
+                    f.read()
             else:
-                raise NotImplementedError('fetch_one_result(%s): cannot handle HTTP code %i' %
+                raise NotImplementedError('download_result(%s): cannot handle HTTP code %i' %
                                           (url, f.getcode()))
+        except tarfile.TarError as e:
+            self.logger.error('%s is damaged, ignoring: %s', url, str(e))
+            return None
         except IOError as e:
             self.logger.error('Failure to fetch %s: %s', url, str(e))
             # we tolerate "not found" (something went wrong on uploading the
             # result), but other things indicate infrastructure problems
             if hasattr(e, 'code') and e.code == 404:
-                return
+                return None
             sys.exit(1)
         finally:
             if f is not None:
                 f.close()
+        return members
+
+    def record_result(self, url, members, src, arch):
+        '''Add a downloaded result for source/arch
+
+        members is what download_result() returned for url. Remove matching
+        pending_tests entries.
+        '''
         try:
-            with tarfile.open(None, 'r', tar_bytes) as tar:
-                exitcode = int(tar.extractfile('exitcode').read().strip())
-                try:
-                    srcver = tar.extractfile('testpkg-version').read().decode().strip()
-                except KeyError as e:
-                    # We have some buggy results in Ubuntu's swift that break a
-                    # full reimport. Sometimes we fake up the exit code (when
-                    # we want to convert tmpfails to permanent fails), but an
-                    # early bug meant we sometimes didn't include a
-                    # testpkg-version.
-                    if exitcode in (4, 12, 20):
-                        # repair it
-                        srcver = "%s unknown" % (src)
-                    else:
-                        raise
-                (ressrc, ver) = srcver.split()
-                testinfo = json.loads(tar.extractfile('testinfo.json').read().decode())
-        except (KeyError, ValueError, tarfile.TarError) as e:
+            exitcode = int(members['exitcode'].strip())
+            try:
+                srcver = members['testpkg-version'].decode().strip()
+            except KeyError as e:
+                # We have some buggy results in Ubuntu's swift that break a
+                # full reimport. Sometimes we fake up the exit code (when
+                # we want to convert tmpfails to permanent fails), but an
+                # early bug meant we sometimes didn't include a
+                # testpkg-version.
+                if exitcode in (4, 12, 20):
+                    # repair it
+                    srcver = "%s unknown" % (src)
+                else:
+                    raise
+            (ressrc, ver) = srcver.split()
+            testinfo = json.loads(members['testinfo.json'].decode())
+        except (KeyError, ValueError) as e:
             self.logger.error('%s is damaged, ignoring: %s', url, str(e))
             # ignore this; this will leave an orphaned request in autopkgtest-pending.json
             # and thus require manual retries after fixing the tmpfail, but we
@@ -1032,8 +1440,7 @@ class AutopkgtestPolicy(BasePolicy):
             return
 
         run_id = os.path.basename(os.path.dirname(url))
-        # 20200101_000000 is 15 chars long
-        seen = round(calendar.timegm(time.strptime(run_id[0:15], '%Y%m%d_%H%M%S')))
+        seen = run_id_timestamp(run_id)
         # allow some skipped tests, but nothing else
         if exitcode in [0, 2]:
             result = Result.PASS
@@ -1046,13 +1453,14 @@ class AutopkgtestPolicy(BasePolicy):
             'Fetched test result for %s/%s/%s %s (triggers: %s): %s',
             src, ver, arch, run_id, result_triggers, result.name.lower())
 
-        # remove matching test requests
-        for trigger in result_triggers:
-            self.remove_from_pending(trigger, src, arch)
+        with self.results_lock:
+            # remove matching test requests
+            for trigger in result_triggers:
+                self.remove_from_pending(trigger, src, arch)
 
-        # add this result
-        for trigger in result_triggers:
-            self.add_trigger_to_results(trigger, src, ver, arch, run_id, seen, result)
+            # add this result
+            for trigger in result_triggers:
+                self.add_trigger_to_results(trigger, src, ver, arch, run_id, seen, result)
 
     def fetch_sqlite_results(self, src, arch):
         '''Retrieve new results for source package/arch from sqlite
@@ -1096,8 +1504,7 @@ class AutopkgtestPolicy(BasePolicy):
                 self.logger.error('%s result has no ADT_TEST_TRIGGERS, ignoring')
                 continue
 
-            # 20200101_000000 is 15 chars long
-            seen = round(calendar.timegm(time.strptime(run_id[:15], '%Y%m%d_%H%M%S')))
+            seen = run_id_timestamp(run_id)
 
             # allow some skipped tests, but nothing else
             if exitcode in (0, 2):
@@ -1120,6 +1527,7 @@ class AutopkgtestPolicy(BasePolicy):
         try:
             arch_list = self.pending_tests[trigger][src]
             arch_list.remove(arch)
+            self.pending_tests_dirty = True
             if not arch_list:
                 del self.pending_tests[trigger][src]
             if not self.pending_tests[trigger]:
@@ -1135,12 +1543,18 @@ class AutopkgtestPolicy(BasePolicy):
         except ValueError:
             self.logger.info('Ignoring invalid test trigger %s', trigger)
             return False
-        if trigsrc == src and apt_pkg.version_compare(ver, trigver) < 0:
+        if trigsrc == src and version_compare(ver, trigver) < 0:
             self.logger.debug('test trigger %s, but run for older version %s, ignoring', trigger, ver)
             return False
 
-        result = self.test_results.setdefault(trigger, {}).setdefault(
-            src, {}).setdefault(arch, [Result.FAIL, None, '', 0])
+        try:
+            result = self.test_results[trigger][src][arch]
+        except KeyError:
+            if trigger not in self.test_results:
+                self.trigger_order[trigger] = len(self.trigger_order)
+            result = self.test_results.setdefault(trigger, {}).setdefault(
+                src, {}).setdefault(arch, [Result.FAIL, None, '', 0])
+            self.result_triggers[src][arch].add(trigger)
 
         # don't clobber existing passed results with non-passing ones from
         # re-runs, except for reference updates
@@ -1150,6 +1564,9 @@ class AutopkgtestPolicy(BasePolicy):
             result[1] = ver
             result[2] = run_id
             result[3] = seen
+            self.test_results_dirty = True
+            if status in PASS_RESULTS:
+                self.passed_src_arch.add((src, arch))
 
         return True
 
@@ -1176,20 +1593,29 @@ class AutopkgtestPolicy(BasePolicy):
 
         if self.amqp_channel:
             import amqplib.client_0_8 as amqp
-            params = json.dumps(params)
+            msg = amqp.Message(src + '\n' + json.dumps(params),
+                               delivery_mode=2)  # persistent
             try:
-                self.amqp_channel.basic_publish(amqp.Message(src + '\n' + params,
-                                                             delivery_mode=2),  # persistent
-                                                routing_key=qname)
+                self.amqp_channel.basic_publish(msg, routing_key=qname)
             except (ConnectionResetError, BrokenPipeError):
-                return False
+                # the broker dropped us; without reconnecting every further
+                # request of this run would fail the same way
+                self.logger.warning('Lost connection to AMQP server, reconnecting')
+                try:
+                    self.amqp_connect(self.options.adt_amqp)
+                    self.amqp_channel.basic_publish(msg, routing_key=qname)
+                except (OSError, amqp.AMQPException):
+                    return False
         else:
             # for file-based submission, triggers are space separated
             params['triggers'] = [' '.join(params['triggers'])]
-            params = json.dumps(params)
+            line = '%s:%s %s\n' % (qname, src, json.dumps(params))
             assert self.amqp_file
-            with open(self.amqp_file, 'a') as f:
-                f.write('%s:%s %s\n' % (qname, src, params))
+            if self.amqp_file_handle is None:
+                # keep it open for the whole run; line buffered, so that each
+                # request is on disk before we record it as pending
+                self.amqp_file_handle = open(self.amqp_file, 'a', buffering=1)
+            self.amqp_file_handle.write(line)
         return True
 
     def pkg_test_request(self, src, arch, full_triggers, huge=False):
@@ -1207,21 +1633,18 @@ class AutopkgtestPolicy(BasePolicy):
 '''
         trigger = full_triggers[0]
         uses_swift = not self.options.adt_swift_url.startswith('file://')
-        try:
-            result = self.test_results[trigger][src][arch]
-            has_result = True
-        except KeyError:
-            has_result = False
+        result = self.test_results.get(trigger, {}).get(src, {}).get(arch)
 
-        if has_result:
+        if result is not None:
             result_state = result[0]
-            version = result[1]
-            if result_state in {Result.OLD_PASS, Result.OLD_FAIL, Result.OLD_NEUTRAL}:
+            # by far the most common case, so check it first
+            if result_state in CURRENT_OK_RESULTS:
+                self.logger.debug('%s/%s triggered by %s already known', src, arch, trigger)
+                return
+            elif result_state in OLD_RESULTS:
                 pass
             elif result_state == Result.FAIL and \
-                    self.result_in_baseline(src, arch)[0] in \
-                    {Result.PASS, Result.NEUTRAL, Result.OLD_PASS,
-                     Result.OLD_NEUTRAL} and \
+                    self.result_in_baseline(src, arch)[0] in OK_RESULTS and \
                     self.options.adt_retry_older_than and \
                     result[3] + int(self.options.adt_retry_older_than) * SECPERDAY < self._now:
                 # We might want to retry this failure, so continue
@@ -1229,9 +1652,6 @@ class AutopkgtestPolicy(BasePolicy):
             elif not uses_swift and not hasattr(self,'db'):
                 # We're done if we don't retrigger and we're not using swift
                 return
-            elif result_state in {Result.PASS, Result.NEUTRAL}:
-                self.logger.debug('%s/%s triggered by %s already known', src, arch, trigger)
-                return
 
         # Without swift or autopkgtest.db we don't expect new results
         if hasattr(self,'db'):
@@ -1254,18 +1674,17 @@ class AutopkgtestPolicy(BasePolicy):
         if not full_triggers:
             full_triggers = [trigger]
 
-        # Don't re-request if it's already pending
-        arch_list = self.pending_tests.setdefault(trigger, {}).setdefault(src, [])
-        if arch in arch_list:
+        # Don't re-request if it's already pending; only create the entry
+        # once the request went out, so that failed ones leave no trace
+        if arch in self.pending_tests.get(trigger, {}).get(src, ()):
             self.logger.info('Test %s/%s for %s is already pending, not queueing', src, arch, trigger)
         else:
             self.logger.info('Requesting %s autopkgtest on %s to verify %s', src, arch, trigger)
             if self.send_test_request(src, arch, full_triggers, huge=huge):
-                # save pending.json right away, so that we don't re-request
+                # record it on disk right away, so that we don't re-request
                 # if britney crashes
-                arch_list.append(arch)
-                arch_list.sort()
-                self.save_pending_json()
+                bisect.insort(self.pending_tests.setdefault(trigger, {}).setdefault(src, []), arch)
+                self.log_pending_request(trigger, src, arch)
 
     def result_in_baseline(self, src, arch):
         '''Get the result for src on arch in the baseline
@@ -1304,23 +1723,24 @@ class AutopkgtestPolicy(BasePolicy):
                 self.logger.debug('Found NO result for src %s in reference: %s',
                                   src, result_reference[0].name)
                 pass
-            self.result_in_baseline_cache[src][arch] = deepcopy(result_reference)
+            self.result_in_baseline_cache[src][arch] = list(result_reference)
             return result_reference
 
         result_ever = [Result.FAIL, None, '', 0]
-        for srcmap in self.test_results.values():
-            try:
-                if srcmap[src][arch][0] != Result.FAIL:
-                    result_ever = srcmap[src][arch]
-                # If we are not looking at a reference run, We don't really
-                # care about anything except the status, so we're done
-                # once we find a PASS.
-                if result_ever[0] == Result.PASS:
-                    break
-            except KeyError:
-                pass
+        # only look at the triggers which have a result for src/arch, but in
+        # the order of test_results, as that decides between non-PASS results
+        triggers = sorted(self.result_triggers.get(src, {}).get(arch, ()), key=self.trigger_order.__getitem__)
+        for trigger in triggers:
+            result = self.test_results[trigger][src][arch]
+            if result[0] != Result.FAIL:
+                result_ever = result
+            # If we are not looking at a reference run, We don't really
+            # care about anything except the status, so we're done
+            # once we find a PASS.
+            if result_ever[0] == Result.PASS:
+                break
 
-        self.result_in_baseline_cache[src][arch] = deepcopy(result_ever)
+        self.result_in_baseline_cache[src][arch] = list(result_ever)
         self.logger.debug('Result for src %s ever: %s', src, result_ever[0].name)
         return result_ever
 
@@ -1330,34 +1750,18 @@ class AutopkgtestPolicy(BasePolicy):
         Return (status, real_version, run_id, log_url) tuple; status is a key in
         EXCUSES_LABELS. run_id is None if the test is still running.
         '''
-        target_suite = self.suite_info.target_suite
-        binaries_info = target_suite.binaries[arch]
-
-        # determine current test result status
-        until = self.find_max_lower_force_reset_test(src, ver, arch)
-
-        # Special-case triggers from linux-meta*: we cannot compare results
-        # against different kernels, as e. g. a DKMS module might work against
-        # the default kernel but fail against a different flavor; so for those,
-        # filter the considered results to only those against our kernel
-        if trigger.startswith('linux-meta'):
-            only_trigger = trigger.split('/', 1)[0]
-            self.logger.info('This is a kernel; we will only look for results triggered by %s when considering regressions',
-                             trigger)
-        else:
-            only_trigger = None
-        ever_passed = self.check_ever_passed_before(src, ver, arch, until, only_trigger=only_trigger)
-
-        fail_result = 'REGRESSION' if ever_passed else 'ALWAYSFAIL'
-
         url = None
         run_id = None
-        try:
-            r = self.test_results[trigger][src][arch]
-            ver = r[1]
-            run_id = r[2]
+        # no exceptions for the common case of a test which is still running
+        r = self.test_results.get(trigger, {}).get(src, {}).get(arch)
+        if r is not None:
+            if r[0] in FAIL_RESULTS:
+                # only failures need the test history; most results are
+                # passes, so don't look at it before knowing
+                fail_result = 'REGRESSION' if self.ever_passed(src, ver, arch, trigger) else 'ALWAYSFAIL'
+                ver = r[1]
+                run_id = r[2]
 
-            if r[0] in {Result.FAIL, Result.OLD_FAIL}:
                 # determine current test result status
                 baseline_result = self.result_in_baseline(src, arch)[0]
 
@@ -1367,9 +1771,7 @@ class AutopkgtestPolicy(BasePolicy):
                     # Check if the autopkgtest exists in the target suite and request it
                     test_in_target = False
                     try:
-                        srcinfo = self.suite_info.target_suite.sources[src]
-                        if 'autopkgtest' in srcinfo.testsuite or self.has_autodep8(srcinfo, binaries_info):
-                            test_in_target = True
+                        test_in_target = self.has_test_in_target(src, arch)
                     except KeyError:
                         pass
                     if test_in_target:
@@ -1394,28 +1796,12 @@ class AutopkgtestPolicy(BasePolicy):
                 if self.has_force_badtest(src, ver, arch):
                     result = 'IGNORE-FAIL'
             else:
+                ver = r[1]
+                run_id = r[2]
                 result = r[0].name
 
-            if self.options.adt_swift_url.startswith('file://'):
-                url = os.path.join(self.options.adt_ci_url,
-                                   'data',
-                                   'autopkgtest',
-                                   self.options.series,
-                                   arch,
-                                   srchash(src),
-                                   src,
-                                   run_id,
-                                   'log.gz')
-            else:
-                url = os.path.join(self.options.adt_swift_url,
-                                   self.swift_container,
-                                   self.options.series,
-                                   arch,
-                                   srchash(src),
-                                   src,
-                                   run_id,
-                                   'log.gz')
-        except KeyError:
+            url = '%s/%s/%s/%s/%s/log.gz' % (self.log_url_prefix, arch, srchash(src), src, run_id)
+        else:
             # no result for src/arch; still running?
             if arch in self.pending_tests.get(trigger, {}).get(src, []):
                 baseline_result = self.result_in_baseline(src, arch)[0]
@@ -1433,6 +1819,27 @@ class AutopkgtestPolicy(BasePolicy):
 
         return (result, ver, run_id, url)
 
+    def ever_passed(self, src, ver, arch, trigger):
+        '''Check if the test of src ever passed on arch, as relevant for trigger
+
+        This ignores results of versions from before any force-reset-test
+        hint for ver.
+        '''
+        # determine current test result status
+        until = self.find_max_lower_force_reset_test(src, ver, arch)
+
+        # Special-case triggers from linux-meta*: we cannot compare results
+        # against different kernels, as e. g. a DKMS module might work against
+        # the default kernel but fail against a different flavor; so for those,
+        # filter the considered results to only those against our kernel
+        if trigger.startswith('linux-meta'):
+            only_trigger = trigger.split('/', 1)[0]
+            self.logger.info('This is a kernel; we will only look for results triggered by %s when considering regressions',
+                             trigger)
+        else:
+            only_trigger = None
+        return self.check_ever_passed_before(src, ver, arch, until, only_trigger=only_trigger)
+
     def check_ever_passed_before(self, src, max_ver, arch, min_ver=None, only_trigger=None):
         '''Check if tests for src ever passed on arch for specified range
 
@@ -1440,43 +1847,38 @@ class AutopkgtestPolicy(BasePolicy):
         [min_ver, max_ver) have passed; otherwise it checks that
         [min_ver, inf) have passed.'''
 
-        # FIXME: add caching
-        for (trigger, srcmap) in self.test_results.items():
-            if only_trigger:
-                trig = trigger.split('/', 1)[0]
-                if only_trigger != trig:
-                    continue
-            try:
-                too_high = apt_pkg.version_compare(srcmap[src][arch][1], max_ver) > 0
-                too_low = apt_pkg.version_compare(srcmap[src][arch][1], min_ver) <= 0 if min_ver else False
+        if (src, arch) not in self.passed_src_arch:
+            return False
 
-                if too_high or too_low:
-                    continue
+        # this does not change per trigger, so work it out up front
+        only_prefix = only_trigger + '/' if only_trigger else None
+        for trigger in self.result_triggers.get(src, {}).get(arch, ()):
+            if only_prefix and not trigger.startswith(only_prefix):
+                continue
+            result = self.test_results[trigger][src][arch]
+            # only passes count, so skip the version comparisons for the rest
+            if result[0] not in PASS_RESULTS:
+                continue
 
-                if srcmap[src][arch][0] in (Result.PASS, Result.OLD_PASS):
-                    return True
-            except KeyError:
-                pass
+            too_high = version_compare(result[1], max_ver) > 0
+            too_low = version_compare(result[1], min_ver) <= 0 if min_ver else False
+
+            if not (too_high or too_low):
+                return True
         return False
 
     def find_max_lower_force_reset_test(self, src, ver, arch):
         '''Find the maximum force-reset-test hint before/including ver'''
-        found_ver = None
 
         if not hasattr(self, 'reset_hints'):
             self.reset_hints = self.hints.search('force-reset-test')
 
-        for hint in self.reset_hints:
-            for mi in hint.packages:
-                if mi.package != src:
-                    continue
-                if (mi.architecture in ['source', arch] and
-                        mi.version != 'all' and
-                        apt_pkg.version_compare(mi.version, ver) <= 0 and
-                        (found_ver is None or apt_pkg.version_compare(found_ver, mi.version) < 0)):
-                    found_ver = mi.version
-
-        return found_ver
+        return max((mi.version for hint in self.reset_hints for mi in hint.packages
+                    if mi.package == src and
+                    mi.architecture in ['source', arch] and
+                    mi.version != 'all' and
+                    version_compare(mi.version, ver) <= 0),
+                   key=version_key, default=None)
 
     def has_higher_force_reset_test(self, src, ver, arch):
         '''Find if there is a minimum force-reset-test hint after/including ver'''
@@ -1491,7 +1893,7 @@ class AutopkgtestPolicy(BasePolicy):
                 self.logger.info('Checking hints for %s/%s/%s: %s' % (src, ver, arch, str(hint)))
                 if (mi.architecture in ['source', arch] and
                         mi.version != 'all' and
-                        apt_pkg.version_compare(mi.version, ver) >= 0):
+                        version_compare(mi.version, ver) >= 0):
                     return True
 
         return False
@@ -1506,7 +1908,7 @@ class AutopkgtestPolicy(BasePolicy):
                 if [mi for mi in hint.packages if mi.architecture in ['source', arch] and
                         (mi.version == 'all' or
                          (mi.version == 'blacklisted' and ver == 'blacklisted') or
-                         (mi.version != 'blacklisted' and apt_pkg.version_compare(ver, mi.version) <= 0))]:
+                         (mi.version != 'blacklisted' and version_compare(ver, mi.version) <= 0))]:
                     return True
 
         return False
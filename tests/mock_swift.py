@@ -27,10 +27,23 @@ class SwiftHTTPRequestHandler(BaseHTTPRequestHandler):
     (/container/?prefix=foo&delimiter=@&marker=foo/bar).
     '''
     # map container -> result.tar path -> (exitcode, testpkg-version[, testinfo])
+    # or raw result.tar contents
     results = {}
+    # map URL path -> HTTP error codes to answer the next requests with
+    errors = {}
+    # map URL path -> URL to redirect to
+    redirects = {}
 
     def do_GET(self):
         p = urlparse(self.path)
+        if self.errors.get(p.path):
+            self.send_error(self.errors[p.path].pop(0))
+            return
+        if p.path in self.redirects:
+            self.send_response(301)
+            self.send_header('Location', self.redirects[p.path])
+            self.end_headers()
+            return
         path_comp = p.path.split('/')
         container = path_comp[1]
         path = '/'.join(path_comp[2:])
@@ -45,11 +58,6 @@ class SwiftHTTPRequestHandler(BaseHTTPRequestHandler):
             return
         try:
             fields = self.results[container][os.path.dirname(path)]
-            try:
-                (exitcode, pkgver, testinfo) = fields
-            except ValueError:
-                (exitcode, pkgver) = fields
-                testinfo = None
         except KeyError:
             self.send_error(404, 'File not found')
             return
@@ -58,6 +66,15 @@ class SwiftHTTPRequestHandler(BaseHTTPRequestHandler):
         self.send_header('Content-type', 'application/octet-stream')
         self.end_headers()
 
+        if isinstance(fields, bytes):
+            self.wfile.write(fields)
+            return
+        try:
+            (exitcode, pkgver, testinfo) = fields
+        except ValueError:
+            (exitcode, pkgver) = fields
+            testinfo = None
+
         tar = io.BytesIO()
         with tarfile.open('result.tar', 'w', tar) as results:
             # add exitcode
@@ -124,6 +141,23 @@ class AutoPkgTestSwiftServer:
         '''
         SwiftHTTPRequestHandler.results = results
 
+    @classmethod
+    def set_errors(klass, errors):
+        '''Set HTTP errors to answer requests with.
+
+        errors is a map: URL path -> list of HTTP codes; each request for the
+        path gets the next code, until the list is exhausted.
+        '''
+        SwiftHTTPRequestHandler.errors = errors
+
+    @classmethod
+    def set_redirects(klass, redirects):
+        '''Set redirects.
+
+        redirects is a map: URL path -> URL to redirect to
+        '''
+        SwiftHTTPRequestHandler.redirects = redirects
+
     def start(self):
         assert self.server_pid is None, 'already started'
         if self.log:
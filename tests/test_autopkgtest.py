@@ -85,6 +85,8 @@ class TestAutopkgtestBase(TestBase):
         # to poke in results)
         self.swift = mock_swift.AutoPkgTestSwiftServer(port=18085)
         self.swift.set_results({})
+        self.swift.set_errors({})
+        self.swift.set_redirects({})
 
         self.db = self.init_sqlite_db(self.db_path)
 
@@ -183,6 +185,15 @@ class TestAutopkgtestBase(TestBase):
 
         self.db.commit()
 
+    def use_swift(self):
+        '''Fetch results from the mock swift server instead of autopkgtest.db'''
+
+        for line in fileinput.input(self.britney_conf, inplace=True):
+            if line.startswith('ADT_DB_URL'):
+                print('ADT_DB_URL        = ')
+            else:
+                sys.stdout.write(line)
+
     def run_it(self, unstable_add, expect_status, expect_excuses={}):
         '''Run britney with some unstable packages and verify excuses.
 
@@ -476,6 +487,33 @@ class AT(TestAutopkgtestBase):
         # but the set of pending tests doesn't change
         self.assertEqual(self.pending_requests, expected_pending)
 
+    def test_pending_log_replayed(self):
+        '''Requests logged by a crashed run are not requested again'''
+
+        self.data.add_default_packages(green=False)
+
+        # a previous run queued some of the tests, but did not get to save
+        # its state
+        pending_log = os.path.join(self.data.path, 'data/testing/state/autopkgtest-pending.json.log')
+        os.makedirs(os.path.dirname(pending_log), exist_ok=True)
+        with open(pending_log, 'w') as f:
+            for arch in ['amd64', 'i386']:
+                for src in ['darkgreen', 'green', 'lightgreen']:
+                    f.write(json.dumps(['green/2', src, arch]) + '\n')
+
+        self.run_it(
+            [('libgreen1', {'Version': '2', 'Source': 'green', 'Depends': 'libc6'}, 'autopkgtest')],
+            {'green': (True, {'green': {'amd64': 'RUNNING-ALWAYSFAIL', 'i386': 'RUNNING-ALWAYSFAIL'}})})
+
+        # nothing gets requested again, and the log is folded into the
+        # pending tests
+        self.assertEqual(self.amqp_requests, set())
+        self.assertEqual(self.pending_requests,
+                         {'green/2': {'darkgreen': ['amd64', 'i386'],
+                                      'green': ['amd64', 'i386'],
+                                      'lightgreen': ['amd64', 'i386']}})
+        self.assertFalse(os.path.exists(pending_log))
+
     def test_multi_rdepends_with_tests_all_pass(self):
         '''Multiple reverse dependencies with tests (all pass)'''
 
@@ -2342,6 +2380,19 @@ class AT(TestAutopkgtestBase):
             {'dkms': (False, {'fancy': {'amd64': 'RUNNING-ALWAYSFAIL', 'i386': 'RUNNING'}})},
             {'dkms': [('old-version', '1'), ('new-version', '2')]})
 
+    def test_no_dkms_autodep8_for_substring(self):
+        '''Depending on a package with "dkms" in its name is not DKMS'''
+
+        self.data.add('libdkms-helper', False, {})
+        self.data.add('fancy-tool', False, {'Source': 'fancy', 'Depends': 'libdkms-helper'})
+
+        self.run_it(
+            [('libdkms-helper', {'Version': '2'}, None)],
+            {'libdkms-helper': (True, {})})
+
+        self.assertEqual(self.pending_requests, {})
+        self.assertEqual(self.amqp_requests, set())
+
     def test_kernel_triggers_dkms(self):
         '''DKMS packages get triggered by kernel uploads'''
 
@@ -2737,6 +2788,150 @@ class AT(TestAutopkgtestBase):
             self.assertEqual(orig_contents, f.read())
 
 
+    def test_swift_results(self):
+        '''Results of several packages are fetched from swift in parallel'''
+
+        self.use_swift()
+        self.data.add_default_packages(green=False)
+
+        self.swift.set_results({'autopkgtest-testing': {
+            'testing/i386/d/darkgreen/20150101_100000@': (0, 'darkgreen 1', tr('green/2')),
+            'testing/amd64/d/darkgreen/20150101_100001@': (0, 'darkgreen 1', tr('green/2')),
+            'testing/i386/l/lightgreen/20150101_100100@': (0, 'lightgreen 1', tr('green/2')),
+            'testing/amd64/l/lightgreen/20150101_100101@': (0, 'lightgreen 1', tr('green/2')),
+            # version in testing fails, version in unstable succeeds
+            'testing/i386/g/green/20150101_020000@': (4, 'green 1', tr('green/1')),
+            'testing/amd64/g/green/20150101_020000@': (4, 'green 1', tr('green/1')),
+            'testing/i386/g/green/20150101_100200@': (0, 'green 2', tr('green/2')),
+            'testing/amd64/g/green/20150101_100201@': (0, 'green 2', tr('green/2')),
+        }})
+
+        out = self.run_it(
+            [('libgreen1', {'Version': '2', 'Source': 'green', 'Depends': 'libc6'}, 'autopkgtest')],
+            {'green': (True, {'green/2': {'amd64': 'PASS', 'i386': 'PASS'},
+                              'lightgreen/1': {'amd64': 'PASS', 'i386': 'PASS'},
+                              'darkgreen/1': {'amd64': 'PASS', 'i386': 'PASS'},
+                              })
+             })[0]
+        self.assertEqual(self.amqp_requests, set())
+        self.assertEqual(self.pending_requests, {})
+        self.assertNotIn('Failure', out, out)
+
+        with open(os.path.join(self.data.path, 'data/testing/state/autopkgtest-results.cache')) as f:
+            res = json.load(f)
+        self.assertEqual(res['green/1']['green']['amd64'],
+                         ['FAIL', '1', '20150101_020000@', 1420077600])
+        self.assertEqual(res['green/2']['lightgreen']['i386'],
+                         ['PASS', '1', '20150101_100100@', 1420106460])
+
+    def test_swift_results_damaged_or_unavailable(self):
+        '''Transient swift errors are retried, missing or damaged results ignored'''
+
+        self.use_swift()
+        self.data.add_default_packages(green=False)
+
+        self.swift.set_results({'autopkgtest-testing': {
+            'testing/i386/d/darkgreen/20150101_100000@': b'this is not a tar file',
+            'testing/amd64/d/darkgreen/20150101_100001@': (0, 'darkgreen 1', tr('green/2')),
+            'testing/i386/l/lightgreen/20150101_100100@': (0, 'lightgreen 1', tr('green/2')),
+            'testing/amd64/l/lightgreen/20150101_100101@': (0, 'lightgreen 1', tr('green/2')),
+            'testing/i386/g/green/20150101_100200@': (0, 'green 2', tr('green/2')),
+            'testing/amd64/g/green/20150101_100201@': (0, 'green 2', tr('green/2')),
+        }})
+        self.swift.set_errors({
+            # succeeds on the second attempt
+            '/autopkgtest-testing/testing/i386/g/green/20150101_100200@/result.tar': [503],
+            # would succeed on the second attempt, but is not retried
+            '/autopkgtest-testing/testing/amd64/l/lightgreen/20150101_100101@/result.tar': [404],
+        })
+
+        out = self.run_it(
+            [('libgreen1', {'Version': '2', 'Source': 'green', 'Depends': 'libc6'}, 'autopkgtest')],
+            {'green': (True, {'green/2': {'amd64': 'PASS', 'i386': 'PASS'},
+                              'lightgreen/1': {'amd64': 'RUNNING-ALWAYSFAIL', 'i386': 'PASS'},
+                              'darkgreen/1': {'amd64': 'PASS', 'i386': 'RUNNING-ALWAYSFAIL'},
+                              })
+             })[0]
+
+        # the ignored results get requested again
+        self.assertEqual(
+            self.amqp_requests,
+            set(['debci-testing-amd64:lightgreen {"triggers": ["green/2"]}',
+                 'debci-testing-i386:darkgreen {"triggers": ["green/2"]}']))
+        self.assertIn('Caught error 503', out)
+        self.assertIn('20150101_100000@/result.tar is damaged', out)
+        self.assertIn('20150101_100101@/result.tar: HTTP Error 404', out)
+
+    def test_swift_results_recorded_in_order(self):
+        '''Results fetched in parallel are recorded in a fixed order'''
+
+        self.use_swift()
+        self.data.add_default_packages(green=False)
+
+        self.swift.set_results({'autopkgtest-testing': {
+            'testing/i386/d/darkgreen/20150101_100000@': (0, 'darkgreen 1', tr('green/2 darkgreen-i386/1')),
+            'testing/amd64/d/darkgreen/20150101_100001@': (0, 'darkgreen 1', tr('green/2 darkgreen-amd64/1')),
+            'testing/i386/l/lightgreen/20150101_100100@': (0, 'lightgreen 1', tr('green/2 lightgreen-i386/1')),
+            'testing/amd64/l/lightgreen/20150101_100101@': (0, 'lightgreen 1', tr('green/2 lightgreen-amd64/1')),
+            'testing/i386/g/green/20150101_100200@': (0, 'green 2', tr('green/2 green-i386/1')),
+            'testing/amd64/g/green/20150101_100201@': (0, 'green 2', tr('green/2 green-amd64/1')),
+        }})
+        # make the first fetched result arrive last
+        self.swift.set_errors({
+            '/autopkgtest-testing/testing/amd64/d/darkgreen/20150101_100001@/result.tar': [503],
+        })
+
+        self.run_it(
+            [('libgreen1', {'Version': '2', 'Source': 'green', 'Depends': 'libc6'}, 'autopkgtest')],
+            {'green': (True, {'green/2': {'amd64': 'PASS', 'i386': 'PASS'},
+                              'lightgreen/1': {'amd64': 'PASS', 'i386': 'PASS'},
+                              'darkgreen/1': {'amd64': 'PASS', 'i386': 'PASS'},
+                              })
+             })
+
+        # new triggers are added in the order of the tests, not in the order
+        # in which their downloads finished
+        with open(os.path.join(self.data.path, 'data/testing/state/autopkgtest-results.cache')) as f:
+            res = json.load(f)
+        self.assertEqual(list(res), ['green/2', 'darkgreen-amd64/1', 'green-amd64/1', 'lightgreen-amd64/1',
+                                     'darkgreen-i386/1', 'green-i386/1', 'lightgreen-i386/1'])
+
+    def test_swift_results_redirected(self):
+        '''Redirects from swift are followed'''
+
+        self.use_swift()
+        self.data.add_default_packages(green=False)
+
+        self.swift.set_results({
+            'autopkgtest-testing': {
+                'testing/i386/d/darkgreen/20150101_100000@': (0, 'darkgreen 1', tr('green/2')),
+                'testing/amd64/d/darkgreen/20150101_100001@': (0, 'darkgreen 1', tr('green/2')),
+                'testing/i386/l/lightgreen/20150101_100100@': (0, 'lightgreen 1', tr('green/2')),
+                'testing/amd64/l/lightgreen/20150101_100101@': (0, 'lightgreen 1', tr('green/2')),
+                # moved away, see below
+                'testing/i386/g/green/20150101_100200@': (4, 'green 2', tr('green/2')),
+                'testing/amd64/g/green/20150101_100201@': (0, 'green 2', tr('green/2')),
+            },
+            'autopkgtest-moved': {
+                'testing/i386/g/green/20150101_100200@': (0, 'green 2', tr('green/2')),
+            },
+        })
+        self.swift.set_redirects({
+            # relative to the requested URL
+            '/autopkgtest-testing/testing/i386/g/green/20150101_100200@/result.tar':
+                '/autopkgtest-moved/testing/i386/g/green/20150101_100200@/result.tar',
+        })
+
+        out = self.run_it(
+            [('libgreen1', {'Version': '2', 'Source': 'green', 'Depends': 'libc6'}, 'autopkgtest')],
+            {'green': (True, {'green/2': {'amd64': 'PASS', 'i386': 'PASS'},
+                              'lightgreen/1': {'amd64': 'PASS', 'i386': 'PASS'},
+                              'darkgreen/1': {'amd64': 'PASS', 'i386': 'PASS'},
+                              })
+             })[0]
+        self.assertEqual(self.amqp_requests, set())
+        self.assertNotIn('Failure', out, out)
+
     def test_swift_url_is_file(self):
         '''Run without swift but with debci file (as Debian does)'''
         '''Based on test_multi_rdepends_with_tests_regression'''